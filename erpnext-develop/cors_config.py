@@ -21,8 +21,28 @@ Ou depuis Python:
 
 import frappe
 from frappe import _
+import copy
+import gzip
+import io
 import json
 import os
+import stat
+import sys
+from contextlib import redirect_stdout
+from functools import lru_cache, wraps
+from pathlib import Path
+from types import MappingProxyType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from werkzeug.wrappers import Response
+except ImportError:
+    # Contexte hors web: seul le middleware a besoin de Response
+    Response = None
 
 # ============================================================================
 # CONSTANTES
@@ -37,10 +57,196 @@ CORS_HEADERS = {
     'Access-Control-Max-Age': '86400'  # 24 heures
 }
 
+# Paires (header, valeur) precalculees pour les hooks appeles a chaque reponse
+_CORS_HEADER_ITEMS = tuple(CORS_HEADERS.items())
+
+# Reponse preflight (OPTIONS): identique pour toutes les requetes
+_PREFLIGHT_BODY = b""
+_PREFLIGHT_HEADERS = list(_CORS_HEADER_ITEMS)
+
+# Cache du site_config.json parse: {chemin: (st_mtime_ns, config)}
+_CONFIG_CACHE = {}
+
+# ============================================================================
+# FONCTIONS UTILITAIRES: SORTIE CONSOLE
+# ============================================================================
+
+def _buffered_output(func):
+    """
+    Regroupe toutes les sorties console d'une fonction en une seule ecriture.
+
+    Les print() sont rediriges vers un tampon memoire, vide sur stdout a la
+    fin de l'appel (y compris en cas d'erreur).
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        out = io.StringIO()
+        try:
+            with redirect_stdout(out):
+                return func(*args, **kwargs)
+        finally:
+            sys.stdout.write(out.getvalue())
+            sys.stdout.flush()
+
+    return wrapper
+
+# ============================================================================
+# FONCTIONS UTILITAIRES: LECTURE/ECRITURE SITE_CONFIG
+# ============================================================================
+
+@lru_cache(maxsize=8)
+def _site_config_path(site=None):
+    """
+    Retourne le chemin de site_config.json, memorise par site.
+
+    Args:
+        site: Nom du site (cle du cache, frappe.local.site)
+
+    Returns:
+        str: Chemin du fichier site_config.json
+    """
+    return frappe.get_site_path('site_config.json')
+
+def _load_site_config(path):
+    """
+    Lit site_config.json en reutilisant le cache si le fichier n'a pas change.
+
+    Args:
+        path: Chemin du fichier site_config.json
+
+    Returns:
+        dict: Copie de la configuration (modifiable par l'appelant)
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+
+    if cached is None or cached[0] != mtime:
+        data = Path(path).read_bytes()
+        config = orjson.loads(data) if orjson is not None else json.loads(data)
+        cached = _CONFIG_CACHE[path] = (mtime, config)
+
+    return copy.deepcopy(cached[1])
+
+def _copy_permissions(path, original_stat):
+    """
+    Applique a un fichier les droits et, si possible, le proprietaire d'un autre.
+
+    Args:
+        path: Chemin du fichier a modifier
+        original_stat: Resultat de os.stat() du fichier de reference
+    """
+    os.chmod(path, stat.S_IMODE(original_stat.st_mode))
+    try:
+        os.chown(path, original_stat.st_uid, original_stat.st_gid)
+    except (AttributeError, PermissionError):
+        pass
+
+def _save_site_config(path, config):
+    """
+    Ecrit site_config.json de maniere atomique et met a jour le cache.
+
+    Le document est serialise en memoire puis ecrit en un seul appel dans
+    un fichier temporaire, qui remplace ensuite l'original: un crash en
+    cours d'ecriture ne peut pas corrompre la configuration du site.
+    Le fichier temporaire recoit les droits et le proprietaire de
+    l'original, et il est supprime si l'ecriture echoue.
+    La version precedente est conservee compressee dans site_config.json.bak.gz,
+    avec les memes droits et proprietaire que site_config.json car elle
+    contient aussi les secrets du site. Un echec de cette sauvegarde est
+    signale sans empecher l'ecriture de la configuration.
+
+    Args:
+        path: Chemin du fichier site_config.json
+        config: Configuration a ecrire
+    """
+    if orjson is not None:
+        data = orjson.dumps(config, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(config, separators=(',', ': '), indent=2).encode('utf-8')
+    tmp_path = path + '.tmp'
+
+    try:
+        original_stat = os.stat(path)
+    except FileNotFoundError:
+        original_stat = None
+
+    try:
+        # Cree en 0600 pour que les secrets (db_password, encryption_key)
+        # ne soient jamais lisibles, puis aligne sur les droits de l'original
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'wb', buffering=len(data) + 4096) as f:
+            if original_stat is not None:
+                _copy_permissions(tmp_path, original_stat)
+
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Sauvegarde compressee (niveau 1: rapide) de la version precedente
+        try:
+            previous = Path(path).read_bytes()
+        except FileNotFoundError:
+            previous = None
+
+        if previous is not None:
+            # Meme droits et proprietaire que l'original (copie des secrets);
+            # un echec de la sauvegarde n'empeche pas l'ecriture de la config
+            backup_path = path + '.bak.gz'
+            try:
+                backup_fd = os.open(backup_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with open(backup_fd, 'wb') as raw:
+                    if original_stat is not None:
+                        _copy_permissions(backup_path, original_stat)
+                    with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1) as f:
+                        f.write(previous)
+            except OSError as e:
+                print(f"[CONFIG] Attention: sauvegarde {backup_path} non ecrite: {str(e)}")
+
+        os.replace(tmp_path, path)
+    finally:
+        # Ne jamais laisser de copie temporaire des secrets en cas d'echec
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    _CONFIG_CACHE[path] = (os.stat(path).st_mtime_ns, copy.deepcopy(config))
+
 # ============================================================================
 # FONCTION: ACTIVATION CORS
 # ============================================================================
 
+def _apply_cors(config, origins):
+    """
+    Applique la configuration CORS a un dict site_config (modifie en place).
+
+    Args:
+        config: Configuration du site
+        origins: Origines autorisees ("*" pour toutes, ou liste d'URLs)
+
+    Returns:
+        dict: Configuration modifiee
+    """
+    config['allow_cors'] = origins
+    config['ignore_csrf'] = 1
+
+    # Ajouter les parametres API si absents
+    if 'api_settings' not in config:
+        config['api_settings'] = {}
+
+    config['api_settings']['enable_api'] = 1
+    config['api_settings']['allow_api_key_authentication'] = 1
+
+    return config
+
+def _apply_local_conf(origins):
+    """Reporte la configuration CORS dans frappe.local.conf si disponible."""
+    try:
+        frappe.local.conf.allow_cors = origins
+        frappe.local.conf.ignore_csrf = 1
+    except:
+        pass
+
 def enable_cors(origins="*"):
     """
     Active CORS pour les origines specifiees.
@@ -55,37 +261,21 @@ def enable_cors(origins="*"):
 
     try:
         # Methode 1: Via site_config.json
-        site_config_path = frappe.get_site_path('site_config.json')
-
-        if os.path.exists(site_config_path):
-            with open(site_config_path, 'r') as f:
-                config = json.load(f)
+        site_config_path = _site_config_path(frappe.local.site)
 
-            # Configurer CORS
-            config['allow_cors'] = origins
-            config['ignore_csrf'] = 1
-
-            # Ajouter les parametres API si absents
-            if 'api_settings' not in config:
-                config['api_settings'] = {}
-
-            config['api_settings']['enable_api'] = 1
-            config['api_settings']['allow_api_key_authentication'] = 1
-
-            with open(site_config_path, 'w') as f:
-                json.dump(config, f, indent=2)
-
-            print(f"[CORS] Configuration mise a jour dans {site_config_path}")
-        else:
+        try:
+            config = _load_site_config(site_config_path)
+        except FileNotFoundError:
             print(f"[CORS] Fichier {site_config_path} non trouve")
             return False
 
+        _apply_cors(config, origins)
+        _save_site_config(site_config_path, config)
+
+        print(f"[CORS] Configuration mise a jour dans {site_config_path}")
+
         # Methode 2: Via frappe.local si disponible
-        try:
-            frappe.local.conf.allow_cors = origins
-            frappe.local.conf.ignore_csrf = 1
-        except:
-            pass
+        _apply_local_conf(origins)
 
         print("[CORS] CORS active avec succes")
         return True
@@ -108,9 +298,9 @@ def add_cors_headers(response=None):
     Returns:
         dict: Headers CORS a ajouter
     """
-    if response:
-        for header, value in CORS_HEADERS.items():
-            response.headers[header] = value
+    if response is not None:
+        # update() remplace les headers existants au lieu de les dupliquer
+        response.headers.update(_CORS_HEADER_ITEMS)
 
     return CORS_HEADERS
 
@@ -119,14 +309,49 @@ def get_cors_headers():
     Retourne les headers CORS configures.
 
     Returns:
-        dict: Headers CORS
+        MappingProxyType: Vue en lecture seule des headers CORS
     """
-    return CORS_HEADERS.copy()
+    return MappingProxyType(CORS_HEADERS)
 
 # ============================================================================
 # FONCTION: CONFIGURATION API
 # ============================================================================
 
+def _apply_api(config, rate_limit, rate_limit_window):
+    """
+    Applique les parametres API a un dict site_config (modifie en place).
+
+    Args:
+        config: Configuration du site
+        rate_limit: Nombre maximum de requetes par fenetre
+        rate_limit_window: Fenetre de temps en secondes
+
+    Returns:
+        dict: Configuration modifiee
+    """
+    config['api_settings'] = {
+        'enable_api': 1,
+        'allow_api_key_authentication': 1,
+        'rate_limit': rate_limit,
+        'rate_limit_window': rate_limit_window
+    }
+
+    return config
+
+def _update_system_settings():
+    """Active l'API dans System Settings si le champ existe."""
+    try:
+        if frappe.db.exists("DocType", "System Settings"):
+            system_settings = frappe.get_doc('System Settings')
+
+            # Activer l'API si le champ existe
+            if hasattr(system_settings, 'enable_api'):
+                system_settings.enable_api = 1
+                system_settings.save(ignore_permissions=True)
+                print("[API] System Settings mis a jour")
+    except Exception as e:
+        print(f"[API] Note: System Settings non modifie: {str(e)}")
+
 def configure_api_settings(rate_limit=1000, rate_limit_window=3600):
     """
     Configure les parametres de l'API ERPNext.
@@ -142,37 +367,21 @@ def configure_api_settings(rate_limit=1000, rate_limit_window=3600):
 
     try:
         # Configurer via site_config
-        site_config_path = frappe.get_site_path('site_config.json')
+        site_config_path = _site_config_path(frappe.local.site)
 
-        if os.path.exists(site_config_path):
-            with open(site_config_path, 'r') as f:
-                config = json.load(f)
-
-            # Ajouter/mettre a jour les parametres API
-            config['api_settings'] = {
-                'enable_api': 1,
-                'allow_api_key_authentication': 1,
-                'rate_limit': rate_limit,
-                'rate_limit_window': rate_limit_window
-            }
+        try:
+            config = _load_site_config(site_config_path)
+        except FileNotFoundError:
+            print(f"[API] Fichier {site_config_path} non trouve")
+            return False
 
-            with open(site_config_path, 'w') as f:
-                json.dump(config, f, indent=2)
+        _apply_api(config, rate_limit, rate_limit_window)
+        _save_site_config(site_config_path, config)
 
-            print(f"[API] Rate limit: {rate_limit} requetes / {rate_limit_window}s")
+        print(f"[API] Rate limit: {rate_limit} requetes / {rate_limit_window}s")
 
         # Essayer de configurer via System Settings
-        try:
-            if frappe.db.exists("DocType", "System Settings"):
-                system_settings = frappe.get_doc('System Settings')
-
-                # Activer l'API si le champ existe
-                if hasattr(system_settings, 'enable_api'):
-                    system_settings.enable_api = 1
-                    system_settings.save(ignore_permissions=True)
-                    print("[API] System Settings mis a jour")
-        except Exception as e:
-            print(f"[API] Note: System Settings non modifie: {str(e)}")
+        _update_system_settings()
 
         print("[API] Parametres API configures avec succes")
         return True
@@ -185,6 +394,19 @@ def configure_api_settings(rate_limit=1000, rate_limit_window=3600):
 # FONCTION: DESACTIVATION CSRF
 # ============================================================================
 
+def _apply_csrf(config):
+    """
+    Desactive CSRF dans un dict site_config (modifie en place).
+
+    Args:
+        config: Configuration du site
+
+    Returns:
+        dict: Configuration modifiee
+    """
+    config['ignore_csrf'] = 1
+    return config
+
 def disable_csrf():
     """
     Desactive la verification CSRF pour les requetes API.
@@ -196,15 +418,11 @@ def disable_csrf():
     print("[CSRF] Desactivation de la verification CSRF...")
 
     try:
-        site_config_path = frappe.get_site_path('site_config.json')
+        site_config_path = _site_config_path(frappe.local.site)
 
-        with open(site_config_path, 'r') as f:
-            config = json.load(f)
-
-        config['ignore_csrf'] = 1
-
-        with open(site_config_path, 'w') as f:
-            json.dump(config, f, indent=2)
+        config = _load_site_config(site_config_path)
+        _apply_csrf(config)
+        _save_site_config(site_config_path, config)
 
         print("[CSRF] Verification CSRF desactivee")
         print("[CSRF] ATTENTION: Cette configuration reduit la securite!")
@@ -235,23 +453,28 @@ def check_cors_config():
     }
 
     try:
-        site_config_path = frappe.get_site_path('site_config.json')
-
-        if os.path.exists(site_config_path):
-            with open(site_config_path, 'r') as f:
-                config = json.load(f)
-
-            config_status['cors_enabled'] = 'allow_cors' in config
-            config_status['origins'] = config.get('allow_cors')
-            config_status['csrf_disabled'] = config.get('ignore_csrf', 0) == 1
+        site_config_path = _site_config_path(frappe.local.site)
 
-            api_settings = config.get('api_settings', {})
-            config_status['api_enabled'] = api_settings.get('enable_api', 0) == 1
-
-            print(f"[CHECK] CORS active: {config_status['cors_enabled']}")
-            print(f"[CHECK] Origines: {config_status['origins']}")
-            print(f"[CHECK] CSRF desactive: {config_status['csrf_disabled']}")
-            print(f"[CHECK] API active: {config_status['api_enabled']}")
+        try:
+            config = _load_site_config(site_config_path)
+        except FileNotFoundError:
+            print(f"[CHECK] Fichier {site_config_path} non trouve")
+            return config_status
+
+        api_settings = config.get('api_settings') or {}
+        origins = config.get('allow_cors')
+
+        config_status = {
+            'cors_enabled': origins is not None,
+            'csrf_disabled': config.get('ignore_csrf') == 1,
+            'api_enabled': api_settings.get('enable_api') == 1,
+            'origins': origins
+        }
+
+        print(f"[CHECK] CORS active: {config_status['cors_enabled']}")
+        print(f"[CHECK] Origines: {config_status['origins']}")
+        print(f"[CHECK] CSRF desactive: {config_status['csrf_disabled']}")
+        print(f"[CHECK] API active: {config_status['api_enabled']}")
 
     except Exception as e:
         print(f"[CHECK] Erreur: {str(e)}")
@@ -262,6 +485,7 @@ def check_cors_config():
 # FONCTION: CONFIGURATION COMPLETE
 # ============================================================================
 
+@_buffered_output
 def setup_for_tailpos():
     """
     Configure CORS et API specifiquement pour TailPOS.
@@ -276,14 +500,30 @@ def setup_for_tailpos():
 
     success = True
 
-    # 1. Activer CORS
-    if not enable_cors("*"):
+    # 1-2. Activer CORS et configurer l'API (une seule lecture, une seule ecriture)
+    print("[CORS] Activation de CORS et configuration API...")
+
+    try:
+        site_config_path = _site_config_path(frappe.local.site)
+
+        config = _load_site_config(site_config_path)
+        _apply_cors(config, "*")
+        _apply_api(config, 1000, 3600)
+        _save_site_config(site_config_path, config)
+
+        _apply_local_conf("*")
+        print(f"[CORS] Configuration mise a jour dans {site_config_path}")
+
+    except FileNotFoundError:
+        print(f"[CORS] Fichier {site_config_path} non trouve")
         success = False
 
-    # 2. Configurer l'API
-    if not configure_api_settings(rate_limit=1000):
+    except Exception as e:
+        print(f"[CORS] Erreur: {str(e)}")
         success = False
 
+    _update_system_settings()
+
     # 3. Verification finale
     print("\n[FINAL] Verification de la configuration...")
     check_cors_config()
@@ -315,10 +555,7 @@ def cors_middleware(get_response):
     def middleware(request):
         # Gerer les requetes OPTIONS (preflight)
         if request.method == 'OPTIONS':
-            from werkzeug.wrappers import Response
-            response = Response()
-            add_cors_headers(response)
-            return response
+            return Response(_PREFLIGHT_BODY, status=204, headers=_PREFLIGHT_HEADERS)
 
         # Traiter la requete normale
         response = get_response(request)
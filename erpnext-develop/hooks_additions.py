@@ -172,10 +172,8 @@ def verify_hooks():
     try:
         import erpnext.hooks as hooks
 
-        checks = {
-            'allow_cors': hasattr(hooks, 'allow_cors'),
-            'ignore_csrf': hasattr(hooks, 'ignore_csrf'),
-        }
+        hooks_vars = vars(hooks)
+        checks = {key: key in hooks_vars for key in ('allow_cors', 'ignore_csrf')}
 
         print("\n[VERIFICATION] Configuration hooks.py:")
         for key, value in checks.items():
@@ -20,11 +20,21 @@ Ou depuis Python:
 
 import frappe
 from frappe import _
+from frappe.model.document import bulk_insert
+from frappe.utils.password import set_encrypted_password
+import io
 import json
 import os
 import secrets
-import string
-from datetime import datetime
+import sys
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ============================================================================
 # CONSTANTES DE CONFIGURATION
@@ -62,26 +72,114 @@ SAMPLE_ITEMS = [
     {"item_code": "ITEM-004", "item_name": "Produit Test 4", "rate": 500, "barcode": "1000000004"},
     {"item_code": "ITEM-005", "item_name": "Produit Test 5", "rate": 75, "barcode": "1000000005"},
 ]
+SAMPLE_ITEM_CODES = [item_data["item_code"] for item_data in SAMPLE_ITEMS]
 
 # Stock initial
 INITIAL_STOCK_QTY = 100
 
+# Messages d'information accumules pendant le setup (ecrits en un seul Error Log)
+_SETUP_LOG = []
+
+# Profondeur d'appel des points d'entree (seul le plus externe ecrit le log)
+_SETUP_LOG_DEPTH = 0
+
 # ============================================================================
 # FONCTIONS UTILITAIRES
 # ============================================================================
 
 def generate_api_key():
     """Genere une cle API aleatoire."""
-    return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(20))
+    return secrets.token_hex(10)  # 20 caracteres
 
 def generate_api_secret():
     """Genere un secret API aleatoire."""
-    return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(40))
+    return secrets.token_hex(20)  # 40 caracteres
+
+def _buffered_output(func):
+    """
+    Regroupe toutes les sorties console d'une fonction en une seule ecriture.
+
+    Les print() sont rediriges vers un tampon memoire, vide sur stdout a la
+    fin de l'appel (y compris en cas d'erreur).
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        out = io.StringIO()
+        try:
+            with redirect_stdout(out):
+                return func(*args, **kwargs)
+        finally:
+            sys.stdout.write(out.getvalue())
+            sys.stdout.flush()
+
+    return wrapper
+
+def _flushes_setup_log(func):
+    """
+    Ecrit le log de setup a la fin d'un point d'entree (bench execute).
+
+    Le log est vide au debut de l'appel le plus externe, puis ecrit et
+    valide a sa fin, y compris en cas d'erreur (apres rollback du travail
+    en cours). Les appels imbriques (ex: depuis main) n'ecrivent rien.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _SETUP_LOG_DEPTH
+
+        if _SETUP_LOG_DEPTH == 0:
+            _SETUP_LOG.clear()
+
+        _SETUP_LOG_DEPTH += 1
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if _SETUP_LOG_DEPTH == 1:
+                frappe.db.rollback()
+            raise
+        finally:
+            _SETUP_LOG_DEPTH -= 1
+            if _SETUP_LOG_DEPTH == 0 and _SETUP_LOG:
+                flush_setup_log()
+                frappe.db.commit()
+
+    return wrapper
+
+@lru_cache(maxsize=8)
+def _accounts_for(site, company_name):
+    """
+    Retourne les comptes (non groupes) d'une company indexes par type.
+
+    Le resultat est memorise pour la duree du processus; le setup ne
+    modifie jamais les comptes. Appeler _accounts_for.cache_clear()
+    si ce n'est plus le cas.
+
+    Args:
+        site: Nom du site (cle du cache, frappe.local.site)
+        company_name: Nom de la company
+
+    Returns:
+        dict: {account_type: nom du premier compte de ce type}
+    """
+    accounts = frappe.get_all("Account",
+        filters={"company": company_name, "is_group": 0},
+        fields=["name", "account_type"])
+
+    accounts_by_type = {}
+    for account in accounts:
+        accounts_by_type.setdefault(account.account_type, account.name)
+
+    return accounts_by_type
 
 def log_info(message):
     """Affiche un message d'information."""
     print(f"[INFO] {message}")
-    frappe.log_error(message, "TailPOS Setup - Info")
+    _SETUP_LOG.append(message)
+
+def flush_setup_log():
+    """Enregistre les messages d'information accumules dans un seul Error Log."""
+    if _SETUP_LOG:
+        frappe.log_error("\n".join(_SETUP_LOG), "TailPOS Setup")
+        _SETUP_LOG.clear()
 
 def log_error(message):
     """Affiche un message d'erreur."""
@@ -107,10 +205,9 @@ def create_company():
 
     try:
         # Verifier si une company existe deja
-        existing_companies = frappe.get_all("Company", limit=1)
+        company_name = frappe.db.get_value("Company", {}, "name")
 
-        if existing_companies:
-            company_name = existing_companies[0].name
+        if company_name:
             log_info(f"Company existante trouvee: {company_name}")
             return company_name
 
@@ -129,7 +226,6 @@ def create_company():
         })
 
         company.insert(ignore_permissions=True)
-        frappe.db.commit()
 
         log_success(f"Company '{DEFAULT_COMPANY}' creee avec succes")
         return company.name
@@ -155,11 +251,11 @@ def create_pos_user():
     log_info(f"Verification de l'utilisateur POS '{POS_USER_EMAIL}'...")
 
     try:
-        # Verifier si l'utilisateur existe
-        if frappe.db.exists("User", POS_USER_EMAIL):
-            log_info(f"Utilisateur '{POS_USER_EMAIL}' existe deja")
+        # Recuperer l'utilisateur s'il existe
+        try:
             user = frappe.get_doc("User", POS_USER_EMAIL)
-        else:
+            log_info(f"Utilisateur '{POS_USER_EMAIL}' existe deja")
+        except frappe.DoesNotExistError:
             # Creer l'utilisateur
             log_info(f"Creation de l'utilisateur '{POS_USER_EMAIL}'...")
 
@@ -183,9 +279,15 @@ def create_pos_user():
         # Ajouter les roles necessaires
         required_roles = ["POS User", "Sales User", "Stock User", "Item Manager"]
 
+        # Recuperer en une requete les roles existants et ceux deja attribues
+        existing_roles = set(frappe.get_all("Role",
+            filters={"name": ("in", required_roles)}, pluck="name"))
+        owned_roles = set(frappe.get_all("Has Role",
+            filters={"parent": POS_USER_EMAIL, "role": ("in", required_roles)}, pluck="role"))
+
         for role_name in required_roles:
             # Verifier que le role existe
-            if not frappe.db.exists("Role", role_name):
+            if role_name not in existing_roles:
                 log_info(f"Creation du role '{role_name}'...")
                 role = frappe.get_doc({
                     "doctype": "Role",
@@ -194,12 +296,7 @@ def create_pos_user():
                 role.insert(ignore_permissions=True)
 
             # Ajouter le role a l'utilisateur s'il ne l'a pas
-            has_role = frappe.db.exists("Has Role", {
-                "parent": POS_USER_EMAIL,
-                "role": role_name
-            })
-
-            if not has_role:
+            if role_name not in owned_roles:
                 user.append("roles", {"role": role_name})
                 log_info(f"Role '{role_name}' ajoute a l'utilisateur")
 
@@ -208,8 +305,6 @@ def create_pos_user():
         # Generer les cles API
         api_key, api_secret = setup_api_access(POS_USER_EMAIL)
 
-        frappe.db.commit()
-
         log_success(f"Utilisateur POS configure avec succes")
 
         return {
@@ -243,19 +338,22 @@ def create_warehouse(company_name):
     log_info(f"Verification de l'entrepot '{warehouse_name}'...")
 
     try:
+        # Recuperer en une requete les entrepots de la company
+        warehouses = {w.name: w.is_group for w in frappe.get_all("Warehouse",
+            filters={"company": company_name}, fields=["name", "is_group"])}
+
         # Verifier si l'entrepot existe
-        if frappe.db.exists("Warehouse", warehouse_name):
+        if warehouse_name in warehouses:
             log_info(f"Entrepot '{warehouse_name}' existe deja")
             return warehouse_name
 
         # Verifier s'il existe un entrepot parent
-        parent_warehouse = frappe.db.get_value("Warehouse",
-            {"company": company_name, "is_group": 1}, "name")
+        parent_warehouse = next((name for name, is_group in warehouses.items() if is_group), None)
 
         if not parent_warehouse:
             # Creer l'entrepot racine
             parent_warehouse = f"All Warehouses - {company_name[:2].upper()}"
-            if not frappe.db.exists("Warehouse", parent_warehouse):
+            if parent_warehouse not in warehouses:
                 root = frappe.get_doc({
                     "doctype": "Warehouse",
                     "warehouse_name": "All Warehouses",
@@ -278,7 +376,6 @@ def create_warehouse(company_name):
         })
 
         warehouse.insert(ignore_permissions=True)
-        frappe.db.commit()
 
         log_success(f"Entrepot '{warehouse.name}' cree avec succes")
         return warehouse.name
@@ -322,7 +419,6 @@ def create_price_list():
         })
 
         price_list.insert(ignore_permissions=True)
-        frappe.db.commit()
 
         log_success(f"Liste de prix '{DEFAULT_PRICE_LIST}' creee")
         return DEFAULT_PRICE_LIST
@@ -337,7 +433,7 @@ def create_price_list():
 # FONCTION: CREATION DU PROFIL POS
 # ============================================================================
 
-def create_pos_profile(company_name, warehouse_name, price_list_name):
+def create_pos_profile(company_name, warehouse_name, price_list_name, customer_name=DEFAULT_CUSTOMER):
     """
     Cree le profil POS par defaut.
 
@@ -345,6 +441,7 @@ def create_pos_profile(company_name, warehouse_name, price_list_name):
         company_name: Nom de la company
         warehouse_name: Nom de l'entrepot
         price_list_name: Nom de la liste de prix
+        customer_name: Nom du client par defaut (retourne par create_customer)
 
     Returns:
         str: Nom du profil POS
@@ -357,45 +454,20 @@ def create_pos_profile(company_name, warehouse_name, price_list_name):
             log_info(f"Profil POS '{DEFAULT_POS_PROFILE}' existe deja")
             return DEFAULT_POS_PROFILE
 
-        # Recuperer les comptes necessaires
-        write_off_account = frappe.db.get_value("Account", {
-            "company": company_name,
-            "account_type": "Expense Account",
-            "is_group": 0
-        }, "name")
+        # Recuperer les comptes necessaires (une seule requete par company)
+        accounts_by_type = _accounts_for(frappe.local.site, company_name)
 
-        write_off_cost_center = frappe.db.get_value("Cost Center", {
-            "company": company_name,
-            "is_group": 0
-        }, "name")
-
-        income_account = frappe.db.get_value("Account", {
-            "company": company_name,
-            "account_type": "Income Account",
-            "is_group": 0
-        }, "name")
+        write_off_account = expense_account = accounts_by_type.get("Expense Account")
+        income_account = accounts_by_type.get("Income Account")
 
-        expense_account = frappe.db.get_value("Account", {
-            "company": company_name,
-            "account_type": "Expense Account",
-            "is_group": 0
-        }, "name")
+        # Compte de caisse (Cash), sinon un compte bancaire
+        cash_account = accounts_by_type.get("Cash") or accounts_by_type.get("Bank")
 
-        # Recuperer le compte de caisse (Cash)
-        cash_account = frappe.db.get_value("Account", {
+        write_off_cost_center = frappe.db.get_value("Cost Center", {
             "company": company_name,
-            "account_type": "Cash",
             "is_group": 0
         }, "name")
 
-        if not cash_account:
-            # Essayer de trouver un compte bancaire
-            cash_account = frappe.db.get_value("Account", {
-                "company": company_name,
-                "account_type": "Bank",
-                "is_group": 0
-            }, "name")
-
         # Creer le profil POS
         log_info(f"Creation du profil POS '{DEFAULT_POS_PROFILE}'...")
 
@@ -410,7 +482,7 @@ def create_pos_profile(company_name, warehouse_name, price_list_name):
             "write_off_cost_center": write_off_cost_center,
             "income_account": income_account,
             "expense_account": expense_account,
-            "customer": DEFAULT_CUSTOMER,
+            "customer": customer_name,
             "disabled": 0
         })
 
@@ -429,7 +501,6 @@ def create_pos_profile(company_name, warehouse_name, price_list_name):
         })
 
         pos_profile.insert(ignore_permissions=True)
-        frappe.db.commit()
 
         log_success(f"Profil POS '{DEFAULT_POS_PROFILE}' cree avec succes")
         return pos_profile.name
@@ -452,13 +523,14 @@ def create_customer():
     Returns:
         str: Nom du client
     """
-    log_info(f"Verification du client '{DEFAULT_CUSTOMER}'...")
-
     try:
-        # Verifier si le client existe
-        if frappe.db.exists("Customer", DEFAULT_CUSTOMER):
+        # Verifier si le client existe (recherche par customer_name: selon le
+        # nommage, le document peut s'appeler DEFAULT_CUSTOMER ou CUST-####)
+        existing_customer = frappe.db.get_value("Customer",
+            {"customer_name": DEFAULT_CUSTOMER}, "name")
+        if existing_customer:
             log_info(f"Client '{DEFAULT_CUSTOMER}' existe deja")
-            return DEFAULT_CUSTOMER
+            return existing_customer
 
         # Creer le client
         log_info(f"Creation du client '{DEFAULT_CUSTOMER}'...")
@@ -472,13 +544,10 @@ def create_customer():
         })
 
         customer.insert(ignore_permissions=True)
-        frappe.db.commit()
 
         log_success(f"Client '{DEFAULT_CUSTOMER}' cree avec succes")
         return customer.name
 
-    except frappe.DuplicateEntryError:
-        return DEFAULT_CUSTOMER
     except Exception as e:
         log_error(f"Erreur creation client: {str(e)}")
         raise
@@ -487,6 +556,7 @@ def create_customer():
 # FONCTION: CREATION DES PRODUITS D'EXEMPLE
 # ============================================================================
 
+@_flushes_setup_log
 def create_sample_items(company_name, warehouse_name, price_list_name):
     """
     Cree les produits d'exemple avec stock initial.
@@ -501,10 +571,14 @@ def create_sample_items(company_name, warehouse_name, price_list_name):
     """
     log_info("Creation des produits d'exemple...")
 
-    created_items = []
+    # Un emplacement par produit, dans l'ordre de SAMPLE_ITEMS
+    created_items = [None] * len(SAMPLE_ITEMS)
 
-    # Verifier/creer le groupe de produits
+    # Verifier/creer le groupe de produits (dans un savepoint: un INSERT
+    # en echec ne doit pas annuler la transaction du setup)
+    item_group_ready = True
     if not frappe.db.exists("Item Group", "Products"):
+        frappe.db.savepoint("sample_item_group")
         try:
             item_group = frappe.get_doc({
                 "doctype": "Item Group",
@@ -513,92 +587,185 @@ def create_sample_items(company_name, warehouse_name, price_list_name):
             })
             item_group.insert(ignore_permissions=True)
             log_info("Groupe 'Products' cree")
-        except:
-            pass
+        except frappe.DuplicateEntryError:
+            frappe.db.rollback(save_point="sample_item_group")
+        except Exception as e:
+            frappe.db.rollback(save_point="sample_item_group")
+            log_error(f"Erreur creation groupe 'Products': {str(e)} (nouveaux produits ignores)")
+            item_group_ready = False
 
-    for item_data in SAMPLE_ITEMS:
-        try:
-            item_code = item_data["item_code"]
-
-            # Verifier si le produit existe
-            if frappe.db.exists("Item", item_code):
-                log_info(f"Produit '{item_code}' existe deja")
-                created_items.append({
-                    "item_code": item_code,
-                    "barcode": item_data["barcode"],
-                    "exists": True
-                })
-                continue
+    # Recuperer en une requete les produits et les prix deja existants
+    existing_items = set(frappe.get_all("Item",
+        filters={"item_code": ["in", SAMPLE_ITEM_CODES]}, pluck="item_code"))
+    existing_prices = set(frappe.get_all("Item Price",
+        filters={"item_code": ["in", SAMPLE_ITEM_CODES], "price_list": price_list_name},
+        pluck="item_code"))
 
-            # Creer le produit
-            log_info(f"Creation du produit '{item_code}'...")
+    new_items = []
 
-            item = frappe.get_doc({
-                "doctype": "Item",
-                "item_code": item_code,
-                "item_name": item_data["item_name"],
-                "item_group": "Products",
-                "stock_uom": "Nos",
-                "is_stock_item": 1,
-                "is_sales_item": 1,
-                "is_purchase_item": 1,
-                "include_item_in_manufacturing": 0,
-                "standard_rate": item_data["rate"],
-                "valuation_rate": item_data["rate"] * 0.7,  # Cout = 70% du prix
-                "opening_stock": INITIAL_STOCK_QTY,
-                "description": f"Produit de test: {item_data['item_name']}"
-            })
+    for index, item_data in enumerate(SAMPLE_ITEMS):
+        item_code = item_data["item_code"]
 
-            # Ajouter le code-barres
-            item.append("barcodes", {
+        # Verifier si le produit existe
+        if item_code in existing_items:
+            log_info(f"Produit '{item_code}' existe deja")
+            created_items[index] = {
+                "item_code": item_code,
                 "barcode": item_data["barcode"],
-                "barcode_type": "EAN"
-            })
+                "exists": True
+            }
+            continue
 
-            item.insert(ignore_permissions=True)
+        # bulk_insert ne valide pas les liens: sans groupe, ne rien creer
+        if not item_group_ready:
+            continue
 
-            # Creer le prix de vente
-            item_price = frappe.get_doc({
-                "doctype": "Item Price",
-                "item_code": item_code,
-                "price_list": price_list_name,
-                "price_list_rate": item_data["rate"],
-                "currency": DEFAULT_CURRENCY,
-                "selling": 1
-            })
-            item_price.insert(ignore_permissions=True)
+        log_info(f"Creation du produit '{item_code}'...")
+        new_items.append((index, item_data))
 
-            # Creer l'entree de stock initiale
-            try:
-                create_stock_entry(item_code, warehouse_name, INITIAL_STOCK_QTY, company_name)
-            except Exception as stock_error:
-                log_error(f"Erreur stock pour {item_code}: {str(stock_error)}")
+    # Inserer les produits (avec leurs codes-barres) puis leurs prix en lots,
+    # de facon atomique: un echec annule tout le lot sans toucher au reste du setup
+    if new_items:
+        frappe.db.savepoint("sample_items")
+        try:
+            # Champs que ItemPrice.validate copierait depuis la liste de prix
+            price_list_details = frappe.db.get_value("Price List", price_list_name,
+                ["buying", "selling", "currency"], as_dict=True)
+
+            bulk_insert("Item",
+                (build_sample_item(item_data) for _, item_data in new_items), chunk_size=500)
+            bulk_insert("Item Price",
+                (build_sample_item_price(item_data, price_list_name, price_list_details)
+                    for _, item_data in new_items
+                    if item_data["item_code"] not in existing_prices),
+                chunk_size=500)
+        except Exception as e:
+            frappe.db.rollback(save_point="sample_items")
+            log_error(f"Erreur creation des produits: {str(e)}")
+            new_items = []
 
-            created_items.append({
-                "item_code": item_code,
-                "barcode": item_data["barcode"],
-                "rate": item_data["rate"],
-                "exists": False
+    # Creer le stock initial: une seule entree de stock pour tous les produits
+    if new_items:
+        frappe.db.savepoint("sample_stock")
+        try:
+            stock_entry = frappe.get_doc({
+                "doctype": "Stock Entry",
+                "stock_entry_type": "Material Receipt",
+                "company": company_name,
+                "items": [{
+                    "item_code": item_data["item_code"],
+                    "t_warehouse": warehouse_name,
+                    "qty": INITIAL_STOCK_QTY,
+                    "basic_rate": item_data["rate"] * 0.7  # Valuation rate du produit
+                } for _, item_data in new_items]
             })
 
-            log_success(f"Produit '{item_code}' cree avec stock initial")
+            stock_entry.insert(ignore_permissions=True)
+            stock_entry.submit()
+        except Exception as stock_error:
+            frappe.db.rollback(save_point="sample_stock")
+            log_error(f"Erreur creation stock initial: {str(stock_error)}")
 
-        except frappe.DuplicateEntryError:
-            log_info(f"Produit '{item_code}' existe deja")
-            created_items.append({
-                "item_code": item_code,
-                "barcode": item_data["barcode"],
-                "exists": True
-            })
-        except Exception as e:
-            log_error(f"Erreur creation produit '{item_code}': {str(e)}")
+    for index, item_data in new_items:
+        item_code = item_data["item_code"]
 
-    frappe.db.commit()
+        created_items[index] = {
+            "item_code": item_code,
+            "barcode": item_data["barcode"],
+            "rate": item_data["rate"],
+            "exists": False
+        }
+
+        log_success(f"Produit '{item_code}' cree avec stock initial")
+
+    # Retirer les produits dont la creation a echoue
+    created_items = [item for item in created_items if item is not None]
 
     log_success(f"{len(created_items)} produits configures")
     return created_items
 
-def create_stock_entry(item_code, warehouse, qty, company):
+def build_sample_item(item_data):
+    """
+    Prepare un document Item (non insere) pour un produit d'exemple.
+
+    Le nom du document et de ses lignes enfants est fixe ici car
+    bulk_insert n'execute ni le nommage ni les validations. Les lignes
+    que Item.validate ajouterait (conversion d'unite) sont donc ajoutees
+    ici, et les effets de after_insert (prix Standard Selling, stock
+    d'ouverture) ne sont pas produits: le prix et le stock sont crees
+    par create_sample_items.
+
+    Args:
+        item_data: Entree de SAMPLE_ITEMS
+
+    Returns:
+        Document: Produit pret pour bulk_insert
+    """
+    item = frappe.new_doc("Item")
+    item.update({
+        "item_code": item_data["item_code"],
+        "item_name": item_data["item_name"],
+        "item_group": "Products",
+        "stock_uom": "Nos",
+        "is_stock_item": 1,
+        "is_sales_item": 1,
+        "is_purchase_item": 1,
+        "include_item_in_manufacturing": 0,
+        "standard_rate": item_data["rate"],
+        "valuation_rate": item_data["rate"] * 0.7,  # Cout = 70% du prix
+        "opening_stock": INITIAL_STOCK_QTY,
+        "description": f"Produit de test: {item_data['item_name']}"
+    })
+    item.name = item_data["item_code"]
+
+    # Ajouter le code-barres
+    barcode = item.append("barcodes", {
+        "barcode": item_data["barcode"],
+        "barcode_type": "EAN"
+    })
+    barcode.name = frappe.generate_hash(length=10)
+
+    # Ligne de conversion de l'unite de stock (ajoutee par Item.validate)
+    uom = item.append("uoms", {
+        "uom": "Nos",
+        "conversion_factor": 1
+    })
+    uom.name = frappe.generate_hash(length=10)
+
+    return item
+
+def build_sample_item_price(item_data, price_list_name, price_list_details):
+    """
+    Prepare un document Item Price (non insere) pour un produit d'exemple.
+
+    bulk_insert n'execute pas ItemPrice.validate: la devise et les flags
+    achat/vente sont donc repris ici de la liste de prix.
+
+    Args:
+        item_data: Entree de SAMPLE_ITEMS
+        price_list_name: Nom de la liste de prix
+        price_list_details: buying, selling et currency de la liste de prix
+
+    Returns:
+        Document: Prix de vente pret pour bulk_insert
+    """
+    item_price = frappe.new_doc("Item Price")
+    item_price.update({
+        "item_code": item_data["item_code"],
+        "item_name": item_data["item_name"],
+        "item_description": f"Produit de test: {item_data['item_name']}",
+        "uom": "Nos",
+        "price_list": price_list_name,
+        "price_list_rate": item_data["rate"],
+        "currency": price_list_details.currency,
+        "buying": price_list_details.buying,
+        "selling": price_list_details.selling
+    })
+    item_price.name = frappe.generate_hash(length=10)
+
+    return item_price
+
+def create_stock_entry(item_code, warehouse, qty, company, basic_rate=None):
     """
     Cree une entree de stock pour initialiser le stock d'un produit.
 
@@ -607,8 +774,12 @@ def create_stock_entry(item_code, warehouse, qty, company):
         warehouse: Entrepot cible
         qty: Quantite
         company: Company
+        basic_rate: Cout unitaire (lu sur le produit si non fourni)
     """
     try:
+        if basic_rate is None:
+            basic_rate = frappe.db.get_value("Item", item_code, "valuation_rate") or 100
+
         stock_entry = frappe.get_doc({
             "doctype": "Stock Entry",
             "stock_entry_type": "Material Receipt",
@@ -617,7 +788,7 @@ def create_stock_entry(item_code, warehouse, qty, company):
                 "item_code": item_code,
                 "t_warehouse": warehouse,
                 "qty": qty,
-                "basic_rate": frappe.db.get_value("Item", item_code, "valuation_rate") or 100
+                "basic_rate": basic_rate
             }]
         })
 
@@ -631,6 +802,7 @@ def create_stock_entry(item_code, warehouse, qty, company):
 # FONCTION: CONFIGURATION DE L'ACCES API
 # ============================================================================
 
+@_flushes_setup_log
 def setup_api_access(user_email):
     """
     Configure l'acces API pour un utilisateur.
@@ -644,20 +816,20 @@ def setup_api_access(user_email):
     log_info(f"Configuration de l'acces API pour '{user_email}'...")
 
     try:
-        user = frappe.get_doc("User", user_email)
-
         # Generer une nouvelle API Key si necessaire
-        api_key = user.api_key
-        if not api_key:
-            api_key = generate_api_key()
-            user.api_key = api_key
+        api_key = frappe.db.get_value("User", user_email, "api_key") or generate_api_key()
 
         # Generer un nouveau API Secret
         api_secret = generate_api_secret()
-        user.api_secret = api_secret
 
-        user.save(ignore_permissions=True)
-        frappe.db.commit()
+        # Mise a jour ciblee (sans charger ni valider le document User).
+        # api_secret est un champ Password: la valeur reelle est chiffree dans
+        # __Auth, la colonne ne contient qu'un masque (comme Document.save).
+        frappe.db.set_value("User", user_email, {
+            "api_key": api_key,
+            "api_secret": "*" * len(api_secret)
+        }, update_modified=False)
+        set_encrypted_password("User", user_email, api_secret, "api_secret")
 
         log_success(f"API Key generee pour '{user_email}'")
 
@@ -671,24 +843,28 @@ def setup_api_access(user_email):
 # FONCTION: SAUVEGARDE DES CREDENTIALS
 # ============================================================================
 
-def save_credentials(credentials_data):
+def save_credentials(credentials_data, bench_path=None):
     """
     Sauvegarde les credentials dans un fichier JSON.
 
     Args:
         credentials_data: Dictionnaire des credentials
+        bench_path: Chemin du bench (determine automatiquement si absent)
     """
     try:
         # Determiner le chemin du fichier
-        bench_path = frappe.utils.get_bench_path()
+        if bench_path is None:
+            bench_path = frappe.utils.get_bench_path()
         file_path = os.path.join(bench_path, "pos_credentials.json")
 
-        # Ajouter la date de generation
-        credentials_data["generated_date"] = datetime.now().isoformat()
+        # Sauvegarder (serialisation en memoire, une seule ecriture)
+        if orjson is not None:
+            data = orjson.dumps(credentials_data, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(credentials_data, indent=2).encode('utf-8')
 
-        # Sauvegarder
-        with open(file_path, 'w') as f:
-            json.dump(credentials_data, f, indent=2)
+        with open(file_path, 'wb') as f:
+            f.write(data)
 
         log_success(f"Credentials sauvegardes dans: {file_path}")
 
@@ -705,6 +881,8 @@ def save_credentials(credentials_data):
 # FONCTION PRINCIPALE
 # ============================================================================
 
+@_buffered_output
+@_flushes_setup_log
 def main():
     """
     Fonction principale - Execute toute la configuration.
@@ -715,6 +893,9 @@ def main():
     print("="*60 + "\n")
 
     try:
+        server_url = frappe.utils.get_url()
+        bench_path = frappe.utils.get_bench_path()
+
         # 1. Creer/recuperer la company
         company_name = create_company()
         print(f"[1/8] Company: {company_name}")
@@ -736,7 +917,8 @@ def main():
         print(f"[5/8] Client: {customer_name}")
 
         # 6. Creer le profil POS
-        pos_profile_name = create_pos_profile(company_name, warehouse_name, price_list_name)
+        pos_profile_name = create_pos_profile(company_name, warehouse_name, price_list_name,
+            customer_name)
         print(f"[6/8] Profil POS: {pos_profile_name or 'Non cree (voir logs)'}")
 
         # 7. Creer les produits d'exemple
@@ -745,10 +927,10 @@ def main():
 
         # 8. Preparer et sauvegarder les credentials
         credentials = {
-            "generated_date": "",
+            "generated_date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
             "pos_user": pos_user,
             "server": {
-                "url": frappe.utils.get_url(),
+                "url": server_url,
                 "site_name": frappe.local.site
             },
             "pos_profile": {
@@ -761,7 +943,7 @@ def main():
             "sample_items": sample_items
         }
 
-        save_credentials(credentials)
+        save_credentials(credentials, bench_path)
         print(f"[8/8] Credentials sauvegardes")
 
         # Resume final
@@ -771,7 +953,7 @@ def main():
         print(f"""
 Informations de connexion TailPOS:
 ----------------------------------
-URL Serveur: {frappe.utils.get_url()}
+URL Serveur: {server_url}
 Utilisateur: {pos_user['email']}
 Mot de passe: {pos_user['password']}
 API Key: {pos_user['api_key']}
@@ -785,6 +967,9 @@ Produits d'exemple: {len(sample_items)} produits avec {INITIAL_STOCK_QTY} unites
 """)
         print("="*60 + "\n")
 
+        # Valider toute la configuration en une seule transaction
+        frappe.db.commit()
+
         return credentials
 
     except Exception as e: